@@ -1,3 +1,183 @@
+import os
+import stat
+import tempfile
+from unittest import mock
+
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import TestCase
+from lxml import etree as ET
+
+from . import views
+from .models import Recipe
+
+
+def recipe_xml(*titles, without_description=()):
+    """Собирает документ <recipes> с рецептами под указанными названиями"""
+    parts = []
+    for title in titles:
+        fields = {
+            "title": title,
+            "description": "Описание",
+            "ingredients": "Мука\nВода",
+            "steps": "Смешать\nИспечь",
+            "colories": "True",
+        }
+        if title in without_description:
+            del fields["description"]
+        parts.append("<recipe>" + "".join(f"<{k}>{v}</{k}>" for k, v in fields.items()) + "</recipe>")
+    return ("<recipes>" + "".join(parts) + "</recipes>").encode("utf-8")
+
+
+class RecipesXMLTestCase(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.xml_path = os.path.join(tmp.name, "recipes.xml")
+        for name, value in (("XML_DIR", tmp.name), ("XML_PATH", self.xml_path)):
+            patcher = mock.patch.object(views, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def upload(self, content, name="recipes.xml"):
+        return views.import_from_xml(SimpleUploadedFile(name, content))
+
+    def temp_files(self):
+        return [name for name in os.listdir(views.XML_DIR) if name.endswith(".tmp")]
+
+
+class ImportFromXMLTests(RecipesXMLTestCase):
+    def test_valid_import_creates_recipes_and_schedules_one_dump(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            ok, msg = self.upload(recipe_xml("Блины", "Оладьи"))
+
+        self.assertTrue(ok, msg)
+        self.assertEqual(msg, "Импортировано 2 рецептов.")
+        self.assertEqual(
+            list(Recipe.objects.order_by("id").values_list("title", flat=True)),
+            ["Блины", "Оладьи"],
+        )
+        self.assertEqual(callbacks, [views.schedule_save_to_xml])
+
+    def test_invalid_later_recipe_imports_nothing(self):
+        ok, msg = self.upload(recipe_xml("Блины", "Оладьи", without_description=("Оладьи",)))
+
+        self.assertFalse(ok)
+        self.assertIn("рецепте №2", msg)
+        self.assertFalse(Recipe.objects.exists())
+
+    def test_oversized_upload_is_rejected(self):
+        content = recipe_xml("Блины")
+        with mock.patch.object(views, "XML_UPLOAD_MAX_SIZE", len(content) - 1):
+            ok, msg = self.upload(content)
+
+        self.assertFalse(ok)
+        self.assertFalse(Recipe.objects.exists())
+
+    def test_doctype_is_rejected(self):
+        content = b'<!DOCTYPE recipes [<!ENTITY e "x">]>' + recipe_xml("Tom &e; Jerry")
+        ok, msg = self.upload(content)
+
+        self.assertFalse(ok)
+        self.assertIn("DOCTYPE", msg)
+        self.assertFalse(Recipe.objects.exists())
+
+    def test_malformed_upload_does_not_break_next_import(self):
+        ok, msg = self.upload(b"<recipes><recipe><title>")
+        self.assertFalse(ok)
+
+        ok, msg = self.upload(recipe_xml("Блины"))
+        self.assertTrue(ok, msg)
+        self.assertEqual(Recipe.objects.get().title, "Блины")
+
+
+class SaveToXMLTests(RecipesXMLTestCase):
+    def create_recipe(self, title):
+        return Recipe.objects.create(
+            title=title,
+            description="Описание",
+            ingredients="Мясо\nТесто",
+            steps="Слепить\nСварить",
+            colories=True,
+        )
+
+    def test_writes_all_recipes_readable_as_media(self):
+        self.create_recipe("Пельмени <домашние> & вкусные")
+        self.create_recipe("Вареники")
+
+        views.save_to_xml()
+
+        recipes = ET.parse(self.xml_path).getroot().findall("recipe")
+        self.assertEqual(
+            [r.findtext("title") for r in recipes],
+            ["Пельмени <домашние> & вкусные", "Вареники"],
+        )
+        self.assertEqual(recipes[0].findtext("ingredients"), "Мясо\nТесто")
+        self.assertEqual(recipes[0].findtext("colories"), "True")
+        self.assertEqual(stat.S_IMODE(os.stat(self.xml_path).st_mode), 0o644)
+        self.assertEqual(self.temp_files(), [])
+
+    def test_failed_dump_keeps_old_file_and_removes_temp(self):
+        self.create_recipe("Вареники")
+        views.save_to_xml()
+        with open(self.xml_path, "rb") as f:
+            before = f.read()
+
+        self.create_recipe("Пельмени")
+        with mock.patch.object(views, "write_xml", side_effect=RuntimeError("boom")):
+            with self.assertRaises(RuntimeError):
+                views.save_to_xml()
+
+        with open(self.xml_path, "rb") as f:
+            self.assertEqual(f.read(), before)
+        self.assertEqual(self.temp_files(), [])
+
+    def test_schedule_save_to_xml_debounces_burst_into_one_dump(self):
+        dumps = []
+        with mock.patch.object(views, "_save_to_xml_in_background", lambda: dumps.append(1)), \
+                mock.patch.object(views, "_xml_dump_requested_at", None):
+            for _ in range(5):
+                views.schedule_save_to_xml()
+            views._xml_dump_timer.join()
+
+        self.assertEqual(dumps, [1])
+
+    def test_schedule_save_to_xml_stops_postponing_after_max_delay(self):
+        with mock.patch.object(views, "XML_DUMP_DELAY", 60), \
+                mock.patch.object(views, "XML_DUMP_MAX_DELAY", 0), \
+                mock.patch.object(views, "_xml_dump_requested_at", None):
+            views.schedule_save_to_xml()
+            pending = views._xml_dump_timer
+            views.schedule_save_to_xml()
+            self.assertIs(views._xml_dump_timer, pending)
+            self.assertFalse(pending.finished.is_set())
+            pending.cancel()
+
+    def test_background_dump_failure_is_logged(self):
+        with mock.patch.object(views, "save_to_xml", side_effect=OSError("disk full")), \
+                mock.patch.object(views.connections, "close_all") as close_all, \
+                mock.patch.object(views, "_xml_dump_requested_at", None):
+            with self.assertLogs("recipes.views", "ERROR") as logs:
+                views._save_to_xml_in_background()
+
+        self.assertIn("disk full", logs.output[0])
+        close_all.assert_called_once_with()
+
+
+class IndexTests(RecipesXMLTestCase):
+    def test_add_recipe_schedules_dump_after_commit(self):
+        data = {
+            "title": "Пельмени",
+            "description": "Описание",
+            "ingredients": "Мясо\nТесто",
+            "steps": "Слепить\nСварить",
+            "colories": "True",
+            "add_recipe": "1",
+        }
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post("/", data)
 
-# Create your tests here.
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Recipe.objects.get().title, "Пельмени")
+        self.assertEqual(callbacks, [views.schedule_save_to_xml])
+        # Файл не пишется в самом запросе
+        self.assertFalse(os.path.exists(self.xml_path))
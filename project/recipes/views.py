@@ -1,62 +1,240 @@
+import logging
 import os
-import uuid
-from xml.etree import ElementTree as ET
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from functools import cache
+from lxml import etree as ET
 from django.shortcuts import render, redirect
 from django.conf import settings
-from django.core.files.storage import default_storage
+from django.db import connections, transaction
 from .models import Recipe
 
-from django.template.defaulttags import register
-
-@register.filter
-def get_item(dictionary, key):
-    return dictionary.get(key)
+try:
+    import fcntl
+except ImportError:  # Windows: межпроцессная блокировка недоступна
+    fcntl = None
 
+logger = logging.getLogger(__name__)
 
 XML_DIR = os.path.join(settings.MEDIA_ROOT, 'recipes')
 XML_PATH = os.path.join(XML_DIR, 'recipes.xml')
 
+# Парсер без подстановки сущностей и сетевых запросов: закрывает XXE и
+# billion laughs, а битый документ отвергается, а не «чинится». Отступы
+# между тегами не сохраняются — импорту они не нужны. Неподставленная
+# сущность обрезала бы текст поля, поэтому документы с DOCTYPE (а только
+# в нём можно объявить сущность) parse_uploaded_xml отвергает целиком
+XML_PARSER_OPTIONS = {
+    "resolve_entities": False,
+    "no_network": True,
+    "huge_tree": False,
+    "recover": False,
+    "remove_blank_text": True,
+}
+_parser_local = threading.local()
+
+# Дерево документа строится в памяти, поэтому размер загрузки ограничен
+XML_UPLOAD_MAX_SIZE = 10 * 1024 * 1024
+
+# Выгрузка откладывается на XML_DUMP_DELAY секунд после последнего запроса,
+# чтобы серия добавлений подряд давала одну запись файла, а не N. При
+# непрерывном потоке запросов откладывать дольше XML_DUMP_MAX_DELAY секунд
+# с первого запроса нельзя, иначе файл мог бы устаревать бесконечно
+XML_DUMP_DELAY = 0.5
+XML_DUMP_MAX_DELAY = 5
+_xml_write_lock = threading.Lock()
+_xml_dump_lock = threading.Lock()
+_xml_dump_timer = None
+_xml_dump_requested_at = None
+
+# Файл выгрузки только создаётся и подменяется, но не удаляется, поэтому
+# после первого найденного файла проверять диск на каждом GET незачем
+_xml_exists = False
+
+# Поля рецепта без id: состав модели после загрузки не меняется
+RECIPE_FIELDS = tuple(f for f in Recipe._meta.fields if f.name != "id")
+RECIPE_FIELD_NAMES = tuple(f.name for f in RECIPE_FIELDS)
+
+
+def get_xml_parser():
+    """Возвращает парсер текущего потока, создавая его при первом обращении.
+
+    XMLParser из lxml нельзя делить между потоками, но внутри потока его
+    можно переиспользовать, не настраивая заново на каждый импорт.
+    """
+    parser = getattr(_parser_local, "parser", None)
+    if parser is None:
+        parser = _parser_local.parser = ET.XMLParser(**XML_PARSER_OPTIONS)
+    return parser
+
+
+def xml_exists():
+    """Есть ли файл выгрузки; stat делается, только пока файл не найден"""
+    global _xml_exists
+    if not _xml_exists:
+        _xml_exists = os.path.exists(XML_PATH)
+    return _xml_exists
+
 
+@cache
 def ensure_dir():
+    """Создаёт каталог выгрузки; mkdir выполняется один раз на процесс"""
     os.makedirs(XML_DIR, exist_ok=True)
 
 
+def write_xml(f):
+    """Потоково пишет все рецепты из базы в открытый бинарный файл.
+
+    В памяти держится только текущий рецепт, а не дерево всей таблицы.
+    """
+    with ET.xmlfile(f, encoding="utf-8") as xf:
+        xf.write_declaration()
+        with xf.element("recipes"):
+            rows = Recipe.objects.values(*RECIPE_FIELD_NAMES).iterator(chunk_size=1000)
+            for row in rows:
+                with xf.element("recipe"):
+                    for name in RECIPE_FIELD_NAMES:
+                        with xf.element(name):
+                            xf.write(str(row[name] or ""))
+
+
+@contextmanager
+def xml_write_lock():
+    """Не даёт двум выгрузкам идти одновременно ни в потоках, ни в процессах.
+
+    Иначе выгрузка, прочитавшая базу раньше, могла бы подменить файл
+    позже более свежей и потерять рецепты.
+    """
+    with _xml_write_lock, open(XML_PATH + ".lock", "ab") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
 def save_to_xml():
-    """Сохраняет все рецепты из базы в единый файл XML"""
+    """Сохраняет все рецепты из базы в единый файл XML.
+
+    Запись идёт во временный файл рядом с XML_PATH, который затем атомарно
+    подменяет старый, поэтому читатели никогда не видят недописанный файл.
+    """
+    global _xml_exists
     ensure_dir()
-    root = ET.Element("recipes")
-    for r in Recipe.objects.all():
-        recipe_el = ET.SubElement(root, "recipe")
-        for field in Recipe._meta.fields:
-            if field.name == "id":
-                continue
-            ET.SubElement(recipe_el, field.name).text = str(getattr(r, field.name, "") or "")
-    tree = ET.ElementTree(root)
-    tree.write(XML_PATH, encoding="utf-8", xml_declaration=True)
-
-
-def import_from_xml(file_path):
+    with xml_write_lock():
+        fd, tmp_path = tempfile.mkstemp(dir=XML_DIR, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write_xml(f)
+                f.flush()
+                os.fsync(f.fileno())
+            # mkstemp создаёт файл с правами 0600, а XML раздаётся как медиа
+            os.chmod(tmp_path, settings.FILE_UPLOAD_PERMISSIONS or 0o644)
+            os.replace(tmp_path, XML_PATH)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        _xml_exists = True
+
+
+def _save_to_xml_in_background():
+    global _xml_dump_requested_at
+    with _xml_dump_lock:
+        # Выгрузка пошла: следующий запрос планирует уже новую
+        _xml_dump_requested_at = None
+    try:
+        save_to_xml()
+    except Exception:
+        # Ответ уже отдан, так что сообщить об ошибке можно только в лог
+        logger.exception("Не удалось выгрузить рецепты в %s", XML_PATH)
+    finally:
+        # Соединения с базой у таймера свои, закрываем их вместе с потоком
+        connections.close_all()
+
+
+def schedule_save_to_xml():
+    """Планирует полную выгрузку в XML, сбрасывая ранее запланированную.
+
+    Вызывается после коммита транзакции, так что ответ не ждёт записи
+    файла, а несколько вызовов подряд сливаются в одну выгрузку. Поток
+    таймера не демонический: при остановке процесса интерпретатор дождётся
+    отложенной выгрузки, а не потеряет её. Если ожидающую выгрузку впервые
+    запросили больше XML_DUMP_MAX_DELAY секунд назад, она уже не сдвигается:
+    её запрос к базе ещё впереди и увидит свежие изменения.
+    """
+    global _xml_dump_timer, _xml_dump_requested_at
+    with _xml_dump_lock:
+        now = time.monotonic()
+        if _xml_dump_requested_at is None:
+            _xml_dump_requested_at = now
+        elif now - _xml_dump_requested_at >= XML_DUMP_MAX_DELAY:
+            return
+        else:
+            _xml_dump_timer.cancel()
+        _xml_dump_timer = threading.Timer(XML_DUMP_DELAY, _save_to_xml_in_background)
+        _xml_dump_timer.start()
+
+
+def parse_uploaded_xml(uploaded):
+    """Разбирает загруженный файл по кускам, по мере их чтения.
+
+    Синтаксическая ошибка всплывает на первом же битом куске, остаток
+    файла не читается и не копируется в память целиком.
+    """
+    if uploaded.size > XML_UPLOAD_MAX_SIZE:
+        raise ValueError(f"Файл больше {XML_UPLOAD_MAX_SIZE // (1024 * 1024)} МБ.")
+    parser = get_xml_parser()
+    try:
+        for chunk in uploaded.chunks():
+            parser.feed(chunk)
+    except Exception:
+        # Сбрасываем недоразобранный документ, чтобы парсер годился дальше
+        try:
+            parser.close()
+        except ET.XMLSyntaxError:
+            pass
+        raise
+
+    root = parser.close()
+    if root.getroottree().docinfo.doctype:
+        raise ValueError("Объявления DOCTYPE и сущностей не поддерживаются.")
+    return root
+
+
+def bulk_add(rows, batch_size=500):
+    """Создаёт рецепты пачками и планирует одну выгрузку в XML на всю пачку"""
+    created = Recipe.objects.bulk_create((Recipe(**row) for row in rows), batch_size=batch_size)
+    transaction.on_commit(schedule_save_to_xml)
+    return len(created)
+
+
+def import_from_xml(uploaded):
     """Импорт рецептов из загруженного XML файла"""
     try:
-        tree = ET.parse(file_path)
-        root = tree.getroot()
+        root = parse_uploaded_xml(uploaded)
 
         # Проверяем структуру
         if root.tag != "recipes":
             raise ValueError("Некорректный корневой элемент (ожидался <recipes>).")
 
-        imported = 0
-        for idx, el in enumerate(root.findall("recipe"), start=1):
+        # Сначала проверяем весь файл, чтобы не импортировать его наполовину
+        rows = []
+        for idx, el in enumerate(root.iterchildren("recipe"), start=1):
+            # Один проход по детям рецепта вместо отдельного find() на каждое поле
+            texts = {}
+            for child in el:
+                texts.setdefault(child.tag, child.text)
+            el.clear()
+
             data = {}
-            for field in Recipe._meta.fields:
-                if field.name == "id":
-                    continue
-                node = el.find(field.name)
-                if node is None or (node.text or "").strip() == "":
-                    raise ValueError(f"Ошибка в рецепте №{idx}: отсутствует тег <{field.name}>.")
-                data[field.name] = node.text.strip()
-            Recipe.objects.create(**data)
-            imported += 1
+            for name in RECIPE_FIELD_NAMES:
+                text = (texts.get(name) or "").strip()
+                if not text:
+                    raise ValueError(f"Ошибка в рецепте №{idx}: отсутствует тег <{name}>.")
+                data[name] = text
+            rows.append(data)
+
+        imported = bulk_add(rows)
         return True, f"Импортировано {imported} рецептов."
 
     except Exception as e:
@@ -64,15 +242,13 @@ def import_from_xml(file_path):
 
 
 def index(request):
-    ensure_dir()
     message = ""
-    fields = [f for f in Recipe._meta.fields if f.name != "id"]
 
     # Добавление рецепта вручную
     if request.method == "POST" and "add_recipe" in request.POST:
-        data = {f.name: request.POST.get(f.name, "") for f in fields}
+        data = {name: request.POST.get(name, "") for name in RECIPE_FIELD_NAMES}
         Recipe.objects.create(**data)
-        save_to_xml()
+        transaction.on_commit(schedule_save_to_xml)
         return redirect("index")
 
     # Загрузка XML-файла
@@ -81,34 +257,17 @@ def index(request):
         if not uploaded:
             message = "Файл не выбран."
         else:
-            # Генерация безопасного имени
-            safe_name = f"upload_{uuid.uuid4().hex}.xml"
-            upload_path = os.path.join(XML_DIR, safe_name)
-            ensure_dir()
-            with default_storage.open(upload_path, "wb+") as destination:
-                for chunk in uploaded.chunks():
-                    destination.write(chunk)
-
             # Проверка валидности
-            ok, msg = import_from_xml(upload_path)
-            if not ok:
-                os.remove(upload_path)
-            else:
-                os.remove(upload_path)
-                save_to_xml()
+            ok, msg = import_from_xml(uploaded)
             message = msg
 
     # Получаем данные из базы
-    recipes = [
-        {f.name: getattr(r, f.name, "") for f in fields}
-        for r in Recipe.objects.all()
-    ]
-    xml_exists = os.path.exists(XML_PATH)
-
+    # Строки значений в порядке RECIPE_FIELDS: шаблону не нужен поиск по ключу
+    recipes = list(Recipe.objects.values_list(*RECIPE_FIELD_NAMES))
     return render(request, "recipes/index.html", {
-        "fields": fields,
+        "fields": RECIPE_FIELDS,
         "recipes": recipes,
-        "xml_exists": xml_exists,
+        "xml_exists": xml_exists(),
         "xml_path": XML_PATH.replace(settings.MEDIA_ROOT, settings.MEDIA_URL),
         "message": message,
     })